@@ -3,6 +3,8 @@ from utils import *
 from datetime import datetime
 from PIL import Image
 import pandas as pd
+import os
+import profiling
 
 def create_about_section():
     st.sidebar.markdown("## About Project")
@@ -24,6 +26,40 @@ def create_about_section():
         """)
 
 
+def create_admin_section(model):
+    """
+    Sidebar tools for operators, shown only when ADMIN_TOOLS=1.
+
+    Returns:
+        The model version selected to serve this session, or None to use routing.
+    """
+    if os.environ.get("ADMIN_TOOLS") != "1":
+        return None
+    st.sidebar.markdown("## Admin")
+    with st.sidebar.expander("⏱️ Profiling", expanded=False):
+        num_requests = st.number_input(
+            "Requests to profile", min_value=1, max_value=100,
+            value=profiling.DEFAULT_PROFILE_REQUESTS
+        )
+        if profiling.remaining():
+            st.markdown(f"Profiling the next **{profiling.remaining()}** requests.")
+            if st.button("Cancel profiling"):
+                profiling.disarm()
+        elif st.button("Profile next requests"):
+            profiling.arm(num_requests)
+            st.markdown(f"Profiling the next **{num_requests}** requests.")
+        if profiling.last_profile_dir:
+            st.markdown(f"Last profile: `{profiling.last_profile_dir}`")
+    with st.sidebar.expander("🧠 Model Versions", expanded=False):
+        st.markdown(f"**Routing:** `{model.routing.get('mode', 'default')}`")
+        pinned_version = st.selectbox(
+            "Serve version", ["(routed)"] + list(model.versions), key="pinned_version"
+        )
+        st.markdown(f"**Loaded:** {', '.join(model.loaded_versions()) or 'none'}")
+        st.dataframe(pd.DataFrame(model.stats()).T)
+    return None if pinned_version == "(routed)" else pinned_version
+
+
 def create_interactive_image_upload():
     st.markdown("## Image Analysis")
 
@@ -207,12 +243,18 @@ def main():
     
     # Initialize components
     create_about_section()
+    profiling.install_signal_handler()
     
     # Load model
     model = load_model_safely()
     if model is None:
         st.error("❌ Model loading failed. Please contact technical support.")
         return
+    pinned_version = create_admin_section(model)
+    if pinned_version:
+        model = load_model_safely(pinned_version)
+        if model is None:
+            return
     
     # Main interface
     image, source = create_interactive_image_upload()
@@ -241,4 +283,5 @@ def main():
                 st.error(f"Export failed: {str(e)}")
 
 if __name__ == "__main__":
-    main()
+    with profiling.request():
+        main()
@@ -0,0 +1,385 @@
+"""
+Startup auto-tuning of TensorFlow thread pools and inference batch size.
+
+TensorFlow thread-pool sizes can only be set before the runtime initializes,
+so every intra-op/inter-op combination is measured in a fresh subprocess.
+Each trial runs a warm-up batch built from ``data_samples`` at several batch
+sizes. Two configurations are selected, each the best throughput whose p95
+batch latency stays under the ceiling:
+
+- ``serving``: thread counts for ``SERVING_BATCH_SIZE`` (the app predicts one
+  image at a time).
+- ``offline``: thread counts and batch size for batch jobs such as
+  ``evaluate.py`` and ``retrain_head.py``.
+
+Results are stored in ``RUNTIME_PROFILES_PATH`` under a fingerprint of the
+host, so later starts on the same hardware reuse them. Named profiles in the
+same file can be selected explicitly with ``RUNTIME_PROFILE=<name>``.
+
+Usage:
+    python autotune.py                       # tune this host and store the result
+    python autotune.py --save-as small-vm    # also store it as a named profile
+    python autotune.py --show                # print the stored configuration
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RUNTIME_PROFILES_PATH = os.environ.get("RUNTIME_PROFILES_PATH", "runtime_profiles.json")
+DEFAULT_MODEL_PATH = "models/model.keras"
+DEFAULT_BATCH_SIZES = (1, 4, 8, 16, 32)
+DEFAULT_LATENCY_CEILING_MS = float(os.environ.get("AUTOTUNE_LATENCY_MS", "1000"))
+DEFAULT_BATCH_SIZE = 32
+SERVING_BATCH_SIZE = 1  # the app preprocesses and predicts a single image per request
+WORKLOADS = ("serving", "offline")
+TRIAL_TIMEOUT = 600  # seconds per subprocess trial
+
+
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def _available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def host_info():
+    """Describe the hardware and software that tuning results depend on."""
+    import tensorflow as tf
+    return {
+        "machine": platform.machine(),
+        "cpu_model": _cpu_model(),
+        "cpus": _available_cpus(),
+        "tensorflow": tf.__version__,
+    }
+
+
+def host_fingerprint(info=None):
+    """Short stable hash of ``host_info``."""
+    info = info or host_info()
+    return hashlib.sha1(json.dumps(info, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_profiles(path=RUNTIME_PROFILES_PATH):
+    """Load the profiles file, returning an empty structure if it is missing or unreadable."""
+    if not os.path.exists(path):
+        return {"hosts": {}, "profiles": {}}
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+        if not isinstance(profiles, dict):
+            raise ValueError("expected a JSON object")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable runtime profiles file {path}: {str(e)}")
+        return {"hosts": {}, "profiles": {}}
+    profiles.setdefault("hosts", {})
+    profiles.setdefault("profiles", {})
+    return profiles
+
+
+def save_profiles(profiles, path=RUNTIME_PROFILES_PATH):
+    """Atomically write the profiles file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def candidate_thread_counts(cpus):
+    """Powers of two up to the number of CPUs, plus the CPU count itself."""
+    counts = {cpus}
+    n = 1
+    while n < cpus:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def _warmup_batch(max_batch_size, target_size=(224, 224)):
+    """Build a batch of real sample images, padded by repetition."""
+    from PIL import Image
+    from utils import SAMPLE_IMAGES_DIR, preprocess_image
+
+    images = []
+    if os.path.isdir(SAMPLE_IMAGES_DIR):
+        for name in sorted(os.listdir(SAMPLE_IMAGES_DIR))[:max_batch_size]:
+            if name.lower().endswith(("jpg", "jpeg", "png")):
+                with Image.open(os.path.join(SAMPLE_IMAGES_DIR, name)) as image:
+                    img_array, error = preprocess_image(image, target_size)
+                if not error:
+                    images.append(img_array[0])
+    if not images:
+        images = [np.random.rand(*target_size, 3).astype(np.float32)]
+    reps = -(-max_batch_size // len(images))
+    return np.stack((images * reps)[:max_batch_size])
+
+
+def run_trial(model_path, intra, inter, batch_sizes, repeats=10):
+    """
+    Measure latency and throughput for one thread configuration.
+
+    Must run in a process where TensorFlow has not been initialized yet.
+
+    Returns:
+        List of dicts with batch_size, p50/p95 latency (ms) and throughput (images/s).
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra)
+    tf.config.threading.set_inter_op_parallelism_threads(inter)
+    model = tf.keras.models.load_model(model_path)
+    warmup = _warmup_batch(max(batch_sizes))
+
+    results = []
+    for batch_size in batch_sizes:
+        batch = warmup[:batch_size]
+        for _ in range(2):
+            model.predict_on_batch(batch)
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model.predict_on_batch(batch)
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies) * 1000
+        results.append({
+            "batch_size": batch_size,
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "images_per_second": float(batch_size * 1000 / latencies.mean()),
+        })
+    return results
+
+
+def select_best(trials, latency_ceiling_ms, batch_size=None):
+    """
+    Pick the configuration with the best throughput under the latency ceiling.
+
+    Falls back to the lowest-latency configuration if none meets the ceiling.
+
+    Args:
+        trials: Results of ``run_trial`` per thread configuration.
+        latency_ceiling_ms: p95 latency limit per batch.
+        batch_size: Only consider this batch size; any batch size if None.
+    """
+    candidates = [
+        dict(intra_op_threads=t["intra_op_threads"], inter_op_threads=t["inter_op_threads"], **r)
+        for t in trials for r in t["results"]
+        if batch_size is None or r["batch_size"] == batch_size
+    ]
+    if not candidates:
+        return None
+    within = [c for c in candidates if c["p95_ms"] <= latency_ceiling_ms]
+    if within:
+        return max(within, key=lambda c: c["images_per_second"])
+    logger.warning(f"No configuration meets the {latency_ceiling_ms:.0f} ms ceiling; using the fastest.")
+    return min(candidates, key=lambda c: c["p95_ms"])
+
+
+def tune(model_path=DEFAULT_MODEL_PATH, batch_sizes=DEFAULT_BATCH_SIZES,
+         latency_ceiling_ms=DEFAULT_LATENCY_CEILING_MS, repeats=10):
+    """
+    Sweep thread counts and batch sizes, one subprocess per thread configuration.
+
+    Returns:
+        Dict with the selected ``serving`` and ``offline`` configurations, or
+        None if every trial failed.
+    """
+    batch_sizes = sorted(set(batch_sizes) | {SERVING_BATCH_SIZE})
+    cpus = _available_cpus()
+    trials = []
+    for intra in candidate_thread_counts(cpus):
+        for inter in sorted({1, 2} & set(range(1, cpus + 1))):
+            command = [
+                sys.executable, os.path.abspath(__file__), "--trial",
+                "--model", model_path, "--intra", str(intra), "--inter", str(inter),
+                "--repeats", str(repeats), "--batch-sizes", *map(str, batch_sizes),
+            ]
+            try:
+                output = subprocess.run(
+                    command, capture_output=True, text=True, check=True, timeout=TRIAL_TIMEOUT
+                ).stdout
+                results = json.loads(output.strip().splitlines()[-1])
+            except (subprocess.SubprocessError, ValueError, IndexError) as e:
+                logger.warning(f"Trial intra={intra} inter={inter} failed: {str(e)}")
+                continue
+            best = max(results, key=lambda r: r["images_per_second"])
+            logger.info(
+                f"intra={intra} inter={inter}: best {best['images_per_second']:.1f} images/s "
+                f"at batch {best['batch_size']} (p95 {best['p95_ms']:.0f} ms)"
+            )
+            trials.append({"intra_op_threads": intra, "inter_op_threads": inter, "results": results})
+
+    if not trials:
+        return None
+    return {
+        "serving": select_best(trials, latency_ceiling_ms, SERVING_BATCH_SIZE),
+        "offline": select_best(trials, latency_ceiling_ms),
+        "latency_ceiling_ms": latency_ceiling_ms,
+        "tuned_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def apply_runtime_config(config):
+    """Apply thread settings; must be called before TensorFlow initializes."""
+    import tensorflow as tf
+    try:
+        if config.get("intra_op_threads"):
+            tf.config.threading.set_intra_op_parallelism_threads(config["intra_op_threads"])
+        if config.get("inter_op_threads"):
+            tf.config.threading.set_inter_op_parallelism_threads(config["inter_op_threads"])
+    except RuntimeError as e:
+        logger.warning(f"Runtime config not applied, TensorFlow is already initialized: {str(e)}")
+        return False
+    return True
+
+
+def resolve_runtime_config(model_path=DEFAULT_MODEL_PATH, workload="serving", path=RUNTIME_PROFILES_PATH):
+    """
+    Find the runtime configuration for this process.
+
+    Order: the named profile in ``RUNTIME_PROFILE``, then the stored result for
+    this host, then a fresh sweep if ``AUTOTUNE=1``. Returns None to keep
+    TensorFlow's defaults.
+
+    Args:
+        model_path: Model to tune with if a sweep is needed.
+        workload: "serving" or "offline".
+        path: Profiles file.
+    """
+    profiles = load_profiles(path)
+
+    name = os.environ.get("RUNTIME_PROFILE")
+    if name:
+        if name in profiles["profiles"]:
+            return _workload_config(profiles["profiles"][name], workload, f"profile:{name}")
+        logger.warning(f"Runtime profile '{name}' not found in {path}")
+
+    info = host_info()
+    fingerprint = host_fingerprint(info)
+    if fingerprint in profiles["hosts"]:
+        return _workload_config(profiles["hosts"][fingerprint], workload, f"host:{fingerprint}")
+
+    if os.environ.get("AUTOTUNE") == "1":
+        logger.info(f"Auto-tuning runtime for host {fingerprint} ({info['cpus']} CPUs)...")
+        best = tune(model_path)
+        if best is not None:
+            profiles["hosts"][fingerprint] = dict(best, host=info)
+            try:
+                save_profiles(profiles, path)
+            except OSError as e:
+                logger.warning(f"Could not save runtime profiles to {path}: {str(e)}")
+            return _workload_config(best, workload, f"host:{fingerprint}")
+    return None
+
+
+def _workload_config(entry, workload, source):
+    config = entry.get(workload)
+    if not isinstance(config, dict):
+        logger.warning(f"Runtime profile {source} has no '{workload}' configuration.")
+        return None
+    return dict(config, source=f"{source}/{workload}")
+
+
+def configure_runtime(model_path=DEFAULT_MODEL_PATH, workload="serving"):
+    """
+    Resolve and apply the runtime configuration, logging the chosen settings.
+
+    Tuning is an optimization only: any failure falls back to TensorFlow's
+    defaults rather than stopping the caller.
+
+    Args:
+        model_path: Model to tune with if a sweep is needed.
+        workload: "serving" for the app (batch 1), "offline" for batch jobs.
+
+    Returns:
+        The applied configuration dict (empty if TensorFlow defaults are kept).
+    """
+    try:
+        config = resolve_runtime_config(model_path, workload)
+    except Exception as e:
+        logger.warning(f"Runtime tuning failed, using TensorFlow defaults: {str(e)}")
+        config = None
+    if config is None:
+        logger.info("Using default TensorFlow thread settings.")
+        return {}
+    apply_runtime_config(config)
+    logger.info(
+        f"Runtime config ({config['source']}): intra_op_threads={config.get('intra_op_threads')}, "
+        f"inter_op_threads={config.get('inter_op_threads')}, batch_size={config.get('batch_size')}"
+    )
+    return config
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Tune TensorFlow thread counts and batch size for this host.")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="Path to the Keras model")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=list(DEFAULT_BATCH_SIZES))
+    parser.add_argument("--latency-ms", type=float, default=DEFAULT_LATENCY_CEILING_MS,
+                        help="p95 latency ceiling per batch")
+    parser.add_argument("--repeats", type=int, default=10, help="Timed runs per batch size")
+    parser.add_argument("--save-as", help="Also store the result as a named profile")
+    parser.add_argument("--show", action="store_true", help="Print the stored configuration and exit")
+    parser.add_argument("--trial", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--intra", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--inter", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.trial:
+        results = run_trial(args.model, args.intra, args.inter, args.batch_sizes, args.repeats)
+        print(json.dumps(results))
+        return 0
+
+    info = host_info()
+    fingerprint = host_fingerprint(info)
+    profiles = load_profiles()
+
+    if args.show:
+        print(json.dumps(profiles["hosts"].get(fingerprint), indent=2))
+        return 0
+
+    best = tune(args.model, args.batch_sizes, args.latency_ms, args.repeats)
+    if best is None:
+        logger.error("All trials failed.")
+        return 1
+    profiles["hosts"][fingerprint] = dict(best, host=info)
+    if args.save_as:
+        profiles["profiles"][args.save_as] = best
+    save_profiles(profiles)
+    for workload in WORKLOADS:
+        config = best[workload]
+        logger.info(
+            f"Selected {workload}: intra_op_threads={config['intra_op_threads']}, "
+            f"inter_op_threads={config['inter_op_threads']}, batch_size={config['batch_size']} "
+            f"({config['images_per_second']:.1f} images/s, p95 {config['p95_ms']:.0f} ms)"
+        )
+    logger.info(f"Saved for host {fingerprint}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""
+Offline evaluation of a trained model on a labeled image directory.
+
+Images are labeled by ``utils.label_from_path``: by their parent directory
+(``train-data/Babesia/x.jpg``) or by the filename prefix used in
+``data_samples`` (``Babesia_3.jpg``). Images are decoded and preprocessed by
+a pool of worker threads a few batches ahead of the model, and every metric
+is accumulated incrementally with vectorized NumPy, so memory use does not
+grow with the size of the directory.
+
+Usage:
+    python evaluate.py data_samples --output results/eval.json
+    python evaluate.py validation-data --baseline results/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+import tensorflow as tf
+
+import autotune
+from utils import CLASS_NAMES, list_labeled_images, logger, stream_batches
+
+# Metrics where a higher value is better; everything else is compared as lower-is-better
+HIGHER_IS_BETTER = ("accuracy", "macro_precision", "macro_recall", "macro_f1")
+
+
+class EvaluationAccumulator:
+    """Incrementally accumulates classification metrics over batches."""
+
+    def __init__(self, num_classes, top_k=(1, 3, 5), num_bins=15):
+        self.num_classes = num_classes
+        self.top_k = tuple(k for k in top_k if k <= num_classes)
+        self.num_bins = num_bins
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.top_k_hits = np.zeros(len(self.top_k), dtype=np.int64)
+        self.bin_counts = np.zeros(num_bins, dtype=np.int64)
+        self.bin_confidence = np.zeros(num_bins, dtype=np.float64)
+        self.bin_correct = np.zeros(num_bins, dtype=np.float64)
+        self.total = 0
+
+    def update(self, labels, probabilities):
+        """
+        Add a batch of predictions.
+
+        Args:
+            labels: Integer array of true classes, shape (n,).
+            probabilities: Softmax outputs, shape (n, num_classes).
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        probabilities = np.asarray(probabilities, dtype=np.float64)
+        predicted = probabilities.argmax(axis=1)
+        k = self.num_classes
+
+        self.confusion += np.bincount(labels * k + predicted, minlength=k * k).reshape(k, k)
+
+        # Rank of the true class = number of classes scored strictly higher
+        true_scores = probabilities[np.arange(len(labels)), labels]
+        ranks = (probabilities > true_scores[:, None]).sum(axis=1)
+        self.top_k_hits += (ranks[None, :] < np.array(self.top_k)[:, None]).sum(axis=1)
+
+        confidence = probabilities.max(axis=1)
+        correct = (predicted == labels).astype(np.float64)
+        bins = np.minimum((confidence * self.num_bins).astype(np.int64), self.num_bins - 1)
+        self.bin_counts += np.bincount(bins, minlength=self.num_bins)
+        self.bin_confidence += np.bincount(bins, weights=confidence, minlength=self.num_bins)
+        self.bin_correct += np.bincount(bins, weights=correct, minlength=self.num_bins)
+
+        self.total += len(labels)
+
+    def result(self):
+        """
+        Summarize the accumulated metrics.
+
+        Returns:
+            JSON-serializable dictionary of metrics.
+        """
+        total = max(self.total, 1)
+        true_positives = np.diag(self.confusion).astype(np.float64)
+        support = self.confusion.sum(axis=1)
+        predicted_count = self.confusion.sum(axis=0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            precision = np.where(predicted_count > 0, true_positives / predicted_count, 0.0)
+            recall = np.where(support > 0, true_positives / support, 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+        present = support > 0
+        gaps = np.abs(self.bin_confidence - self.bin_correct)
+        ece = float(gaps.sum() / total)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mce = float(np.max(np.where(self.bin_counts > 0, gaps / self.bin_counts, 0.0)))
+
+        per_class = {
+            CLASS_NAMES[i]: {
+                "precision": float(precision[i]),
+                "recall": float(recall[i]),
+                "f1": float(f1[i]),
+                "support": int(support[i]),
+            }
+            for i in range(self.num_classes)
+        }
+
+        metrics = {
+            "accuracy": float(true_positives.sum() / total),
+            "macro_precision": float(precision[present].mean()) if present.any() else 0.0,
+            "macro_recall": float(recall[present].mean()) if present.any() else 0.0,
+            "macro_f1": float(f1[present].mean()) if present.any() else 0.0,
+            "ece": ece,
+            "mce": mce,
+        }
+        for k, hits in zip(self.top_k, self.top_k_hits):
+            metrics[f"top_{k}_accuracy"] = float(hits / total)
+
+        return {
+            "num_samples": int(self.total),
+            "metrics": metrics,
+            "per_class": per_class,
+            "confusion_matrix": self.confusion.tolist(),
+            "class_names": [CLASS_NAMES[i] for i in range(self.num_classes)],
+        }
+
+
+def evaluate(model, items, batch_size=32, workers=4, prefetch=2, top_k=(1, 3, 5)):
+    """
+    Run the model over labeled images and accumulate metrics.
+
+    Args:
+        model: The trained TensorFlow model.
+        items: List of (path, class index) tuples.
+        batch_size: Number of images per forward pass.
+        workers: Number of decoding threads.
+        prefetch: Number of batches decoded ahead of the model.
+        top_k: Values of k to report top-k accuracy for.
+
+    Returns:
+        Dictionary of metrics as produced by ``EvaluationAccumulator.result``.
+    """
+    accumulator = EvaluationAccumulator(len(CLASS_NAMES), top_k=top_k)
+    start = time.perf_counter()
+    for images, labels in stream_batches(items, batch_size, workers, prefetch):
+        probabilities = model.predict_on_batch(images)
+        accumulator.update(labels, probabilities)
+    elapsed = time.perf_counter() - start
+
+    results = accumulator.result()
+    results["elapsed_seconds"] = elapsed
+    results["images_per_second"] = accumulator.total / elapsed if elapsed > 0 else 0.0
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.01):
+    """
+    Compare evaluation results against a stored baseline.
+
+    Args:
+        results: Metrics from ``evaluate``.
+        baseline: Metrics previously written by this script.
+        tolerance: Allowed absolute change before a metric counts as regressed.
+
+    Returns:
+        List of human-readable regression descriptions (empty if none).
+    """
+    regressions = []
+    for name, old in baseline.get("metrics", {}).items():
+        new = results["metrics"].get(name)
+        if new is None:
+            continue
+        delta = new - old
+        worse = delta < -tolerance if name.startswith("top_") or name in HIGHER_IS_BETTER else delta > tolerance
+        if worse:
+            regressions.append(f"{name}: {old:.4f} -> {new:.4f} ({delta:+.4f})")
+
+    for name, old in baseline.get("per_class", {}).items():
+        new = results["per_class"].get(name)
+        if new is None or not new["support"]:
+            continue
+        delta = new["recall"] - old["recall"]
+        if delta < -tolerance:
+            regressions.append(f"{name} recall: {old['recall']:.4f} -> {new['recall']:.4f} ({delta:+.4f})")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate a trained model on a labeled image directory.")
+    parser.add_argument("data_dir", nargs="?", default="data_samples", help="Directory of labeled images")
+    parser.add_argument("--model", default="models/model.keras", help="Path to the Keras model")
+    parser.add_argument("--output", help="Write the results as JSON to this path")
+    parser.add_argument("--baseline", help="Compare against a previously written results JSON")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Allowed metric drop vs. the baseline")
+    parser.add_argument("--batch-size", type=int, help="Defaults to the tuned batch size for this host, else 32")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Decoding threads")
+    parser.add_argument("--prefetch", type=int, default=2, help="Batches decoded ahead of the model")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[1, 3, 5])
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    items = list_labeled_images(args.data_dir)
+    if not items:
+        logger.error(f"No labeled images found in {args.data_dir}")
+        return 1
+    logger.info(f"Evaluating {len(items)} images from {args.data_dir}")
+
+    runtime_config = autotune.configure_runtime(args.model, workload="offline")
+    batch_size = args.batch_size or runtime_config.get("batch_size", autotune.DEFAULT_BATCH_SIZE)
+    model = tf.keras.models.load_model(args.model)
+    results = evaluate(model, items, batch_size, args.workers, args.prefetch, args.top_k)
+    results["model"] = args.model
+    results["data_dir"] = args.data_dir
+
+    for name, value in results["metrics"].items():
+        logger.info(f"{name}: {value:.4f}")
+    logger.info(f"Throughput: {results['images_per_second']:.1f} images/s")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            for regression in regressions:
+                logger.error(f"Regression: {regression}")
+            return 1
+        logger.info("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
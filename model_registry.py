@@ -0,0 +1,275 @@
+"""
+Hosting of several model versions with request routing and LRU eviction.
+
+The registry is configured by ``models/registry.json`` (override with
+``MODEL_REGISTRY_PATH``)::
+
+    {
+        "default": "v1",
+        "versions": {"v1": "models/model.keras", "v2": "models/model_v2.keras"},
+        "routing": {"mode": "split", "split": {"v1": 90, "v2": 10}},
+        "memory_budget_mb": 2048
+    }
+
+Routing modes:
+
+- ``default``: every request goes to the default version.
+- ``split``: requests are spread across versions by percentage. The split
+  is keyed on the image contents, so the same image always gets the same
+  version, including across Streamlit reruns.
+- ``shadow``: the default version answers; the ``candidate`` version runs on
+  the same preprocessed batch in the background and only its latency and
+  disagreement with the default are recorded.
+
+A request can always pin a version explicitly, and ``pinned`` returns a
+model-like view of the registry fixed to one version. Loaded models are evicted
+least-recently-used first once their estimated weight memory exceeds the
+budget. Without a config file the registry serves ``models/model.keras``
+alone, as before.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tensorflow.keras.models import load_model
+
+logger = logging.getLogger(__name__)
+
+MODEL_REGISTRY_PATH = os.environ.get("MODEL_REGISTRY_PATH", "models/registry.json")
+DEFAULT_MODEL_PATH = "models/model.keras"
+DEFAULT_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "4096"))
+LATENCY_WINDOW = 1000  # recent latencies kept per version for percentiles
+MAX_PENDING_SHADOW = 8  # shadow runs queued beyond this are dropped
+
+
+def model_size(path):
+    """Size of a saved model on disk: the file, or every file of a SavedModel directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    )
+
+
+class VersionStats:
+    """Latency and disagreement statistics of one model version."""
+
+    def __init__(self):
+        self.requests = 0
+        self.shadow_requests = 0
+        self.dropped_shadow = 0
+        self.disagreements = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000
+        has_latencies = len(latencies) > 0
+        return {
+            "requests": self.requests,
+            "shadow_requests": self.shadow_requests,
+            "dropped_shadow": self.dropped_shadow,
+            "disagreement_rate": self.disagreements / self.shadow_requests if self.shadow_requests else None,
+            "p50_ms": float(np.percentile(latencies, 50)) if has_latencies else None,
+            "p95_ms": float(np.percentile(latencies, 95)) if has_latencies else None,
+        }
+
+
+class ModelRegistry:
+    """Loads, routes between and evicts model versions."""
+
+    def __init__(self, versions, default=None, routing=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+        if not versions:
+            raise ValueError("The registry needs at least one model version.")
+        self.versions = dict(versions)
+        self.default = default or next(iter(self.versions))
+        if self.default not in self.versions:
+            raise ValueError(f"Unknown default version: {self.default}")
+        self.routing = routing or {"mode": "default"}
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._validate_routing()
+
+        self._models = OrderedDict()  # version -> (model, size in bytes), in LRU order
+        self._lock = threading.Lock()  # guards the LRU bookkeeping only, never held while loading
+        self._load_locks = {version: threading.Lock() for version in self.versions}
+        self._stats = {version: VersionStats() for version in self.versions}
+        self._shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+        self._pending_shadow = 0
+
+    @classmethod
+    def from_config(cls, path=MODEL_REGISTRY_PATH):
+        """Build a registry from a JSON config, or serve the single default model if absent."""
+        if not os.path.exists(path):
+            return cls({"default": DEFAULT_MODEL_PATH})
+        with open(path) as f:
+            config = json.load(f)
+        return cls(
+            config["versions"],
+            default=config.get("default"),
+            routing=config.get("routing"),
+            memory_budget_mb=config.get("memory_budget_mb", DEFAULT_MEMORY_BUDGET_MB),
+        )
+
+    def _validate_routing(self):
+        mode = self.routing.get("mode", "default")
+        if mode == "split":
+            unknown = set(self.routing.get("split", {})) - set(self.versions)
+            if unknown or not sum(self.routing.get("split", {}).values()):
+                raise ValueError(f"Invalid split routing: {self.routing}")
+        elif mode == "shadow":
+            if self.routing.get("candidate") not in self.versions:
+                raise ValueError(f"Unknown shadow candidate: {self.routing.get('candidate')}")
+        elif mode != "default":
+            raise ValueError(f"Unknown routing mode: {mode}")
+
+    def get(self, version=None):
+        """
+        Return the loaded model for a version, loading it if necessary.
+
+        Args:
+            version: Version name; the default version if omitted.
+        """
+        version = version or self.default
+        if version not in self.versions:
+            raise KeyError(f"Unknown model version: {version}")
+        model = self._lookup(version)
+        if model is not None:
+            return model
+
+        # Only requests for this version wait while it loads
+        with self._load_locks[version]:
+            model = self._lookup(version)  # loaded by another thread meanwhile
+            if model is not None:
+                return model
+            path = self.versions[version]
+            with self._lock:
+                self._evict(model_size(path), keep=version)
+            model = load_model(path)
+            size = sum(int(np.prod(w.shape)) * w.dtype.size for w in model.weights)
+            with self._lock:
+                self._models[version] = (model, size)
+                self._evict(0, keep=version)
+        logger.info(f"Loaded model version '{version}' from {path} ({size / 2**20:.0f} MB).")
+        return model
+
+    def _lookup(self, version):
+        with self._lock:
+            if version not in self._models:
+                return None
+            self._models.move_to_end(version)
+            return self._models[version][0]
+
+    def _evict(self, incoming, keep):
+        """Drop least-recently-used models until ``incoming`` more bytes fit the budget."""
+        used = sum(size for _, size in self._models.values())
+        for version in list(self._models):
+            if used + incoming <= self.memory_budget:
+                break
+            if version == keep:
+                continue
+            _, size = self._models.pop(version)
+            used -= size
+            logger.info(f"Evicted model version '{version}' ({size / 2**20:.0f} MB).")
+
+    def loaded_versions(self):
+        """Loaded versions, least recently used first."""
+        with self._lock:
+            return list(self._models)
+
+    def route(self, version=None, request_key=b""):
+        """
+        Choose the serving version and optional shadow version for a request.
+
+        Args:
+            version: Pin the request to this version, bypassing routing.
+            request_key: Bytes identifying the request; equal keys get the same split version.
+
+        Returns:
+            Tuple: (serving version, shadow version or None)
+        """
+        if version:
+            return version, None
+        mode = self.routing.get("mode", "default")
+        if mode == "split":
+            split = self.routing["split"]
+            bucket = int.from_bytes(hashlib.sha1(request_key).digest()[:8], "big") % sum(split.values())
+            for candidate, share in split.items():
+                if bucket < share:
+                    return candidate, None
+                bucket -= share
+        if mode == "shadow":
+            return self.default, self.routing["candidate"]
+        return self.default, None
+
+    def _timed_predict(self, version, img_array):
+        model = self.get(version)
+        start = time.perf_counter()
+        prediction = model.predict_on_batch(img_array)
+        self._stats[version].latencies.append(time.perf_counter() - start)
+        return np.asarray(prediction)
+
+    def _run_shadow(self, version, img_array, served):
+        try:
+            prediction = self._timed_predict(version, img_array)
+            stats = self._stats[version]
+            stats.shadow_requests += 1
+            stats.disagreements += int(np.any(prediction.argmax(axis=1) != served.argmax(axis=1)))
+        except Exception as e:
+            logger.error(f"Shadow prediction with '{version}' failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._pending_shadow -= 1
+
+    def predict(self, img_array, verbose=0, version=None):
+        """
+        Predict with the routed version, mirroring ``Model.predict``.
+
+        Args:
+            img_array: Preprocessed image batch.
+            verbose: Accepted for compatibility with ``Model.predict``; ignored.
+            version: Pin the request to this version, bypassing routing.
+
+        Returns:
+            Softmax outputs of the serving version.
+        """
+        request_key = np.ascontiguousarray(img_array).tobytes() if self.routing.get("mode") == "split" else b""
+        served_version, shadow_version = self.route(version, request_key)
+        prediction = self._timed_predict(served_version, img_array)
+        self._stats[served_version].requests += 1
+
+        if shadow_version and shadow_version != served_version:
+            with self._lock:
+                queue_full = self._pending_shadow >= MAX_PENDING_SHADOW
+                if not queue_full:
+                    self._pending_shadow += 1
+            if queue_full:
+                self._stats[shadow_version].dropped_shadow += 1
+            else:
+                self._shadow_executor.submit(self._run_shadow, shadow_version, img_array, prediction)
+        return prediction
+
+    def pinned(self, version):
+        """Model-like view of the registry that always predicts with ``version``."""
+        if version not in self.versions:
+            raise KeyError(f"Unknown model version: {version}")
+        return PinnedModel(self, version)
+
+    def stats(self):
+        """Per-version request, latency and disagreement statistics."""
+        return {version: stats.summary() for version, stats in self._stats.items()}
+
+
+class PinnedModel:
+    """A registry view fixed to one version, usable wherever a model is expected."""
+
+    def __init__(self, registry, version):
+        self.registry = registry
+        self.version = version
+
+    def predict(self, img_array, verbose=0):
+        return self.registry.predict(img_array, verbose, version=self.version)
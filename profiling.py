@@ -0,0 +1,257 @@
+"""
+On-demand profiling of the live inference path.
+
+Profiling is armed at runtime for the next N requests, either from the admin
+section of the sidebar or by sending SIGUSR1 to the process. Each profiled
+request writes to its own timestamped directory under ``PROFILE_DIR``:
+
+- ``render.folded``: sampled stacks of the Streamlit render path, in the
+  collapsed format read by flamegraph.pl and speedscope.
+- ``preprocess_image_<n>.prof``: cProfile stats, readable by snakeviz,
+  flameprof or ``pstats``.
+- ``plugins/profile/...``: TensorFlow profiler trace of ``predict_image``,
+  readable by TensorBoard (``tensorboard --logdir <dir>``).
+
+When nothing is armed every hook returns a shared no-op context manager after
+a single integer check, so the hooks are safe to leave in place. A profiler
+that fails to start, stop or write is logged and the request is served
+unprofiled; profiling never fails a request.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import cProfile
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+DEFAULT_PROFILE_REQUESTS = int(os.environ.get("PROFILE_REQUESTS", "5"))
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples of the render path
+
+_NULL_CONTEXT = nullcontext()
+_state_lock = threading.Lock()
+_tf_trace_lock = threading.Lock()
+_local = threading.local()
+_remaining = 0
+_active = 0
+_signal_installed = False
+last_profile_dir = None
+
+
+def arm(num_requests=DEFAULT_PROFILE_REQUESTS):
+    """Profile the next ``num_requests`` requests."""
+    global _remaining
+    with _state_lock:
+        _remaining = max(0, int(num_requests))
+    logger.info(f"Profiling armed for the next {_remaining} requests.")
+
+
+def disarm():
+    """Cancel any pending profiled requests."""
+    global _remaining
+    with _state_lock:
+        _remaining = 0
+
+
+def remaining():
+    """Number of upcoming requests that will be profiled."""
+    return _remaining
+
+
+def _handle_signal(signum, frame):
+    arm(DEFAULT_PROFILE_REQUESTS)
+
+
+def install_signal_handler(signum=getattr(signal, "SIGUSR1", None)):
+    """
+    Arm profiling when the process receives ``signum`` (SIGUSR1 by default).
+
+    Signal handlers can only be registered from the main thread. Streamlit
+    runs app scripts in a worker thread, so in that case the registration is
+    scheduled on the Streamlit server's event loop, which owns the main thread.
+
+    Returns:
+        True if the handler is (or will be) installed, False otherwise.
+    """
+    global _signal_installed
+    if _signal_installed or signum is None:
+        return _signal_installed
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signum, _handle_signal)
+    else:
+        try:
+            from streamlit.runtime import Runtime
+            loop = Runtime.instance()._get_async_objs().eventloop
+            loop.call_soon_threadsafe(signal.signal, signum, _handle_signal)
+        except Exception as e:
+            logger.warning(f"Could not install profiling signal handler: {str(e)}")
+            return False
+    _signal_installed = True
+    logger.info(f"Send signal {int(signum)} to pid {os.getpid()} to profile the next requests.")
+    return True
+
+
+class _StackSampler(threading.Thread):
+    """Periodically samples the stack of one thread into collapsed stacks."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfileSession:
+    """Collects all profiles of a single request into one directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._counts = Counter()
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def python_profile(self, name):
+        """Run the block under cProfile and dump the stats."""
+        self._counts[name] += 1
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            try:
+                profiler.dump_stats(os.path.join(self.directory, f"{name}_{self._counts[name]}.prof"))
+            except Exception as e:
+                logger.error(f"Could not write profile of {name}: {str(e)}")
+
+    @contextmanager
+    def tf_trace(self):
+        """Capture a TensorFlow profiler trace of the block."""
+        # The TensorFlow profiler is process-wide; skip if another request holds it
+        if not _tf_trace_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            try:
+                import tensorflow as tf
+                tf.profiler.experimental.start(self.directory)
+            except Exception as e:
+                logger.error(f"Could not start the TensorFlow profiler: {str(e)}")
+                yield
+                return
+            try:
+                yield
+            finally:
+                try:
+                    tf.profiler.experimental.stop()
+                except Exception as e:
+                    logger.error(f"Could not stop the TensorFlow profiler: {str(e)}")
+        finally:
+            _tf_trace_lock.release()
+
+
+def request():
+    """
+    Context manager wrapping one request (one run of the Streamlit script).
+
+    Samples the render path and activates ``section``/``tf_trace`` for the
+    duration of the request if profiling is armed; otherwise does nothing.
+    """
+    if not _remaining:
+        return _NULL_CONTEXT
+    return _profiled_request()
+
+
+@contextmanager
+def _profiled_request():
+    global _remaining, _active, last_profile_dir
+    with _state_lock:
+        if not _remaining:
+            armed = False
+        else:
+            _remaining -= 1
+            _active += 1
+            armed = True
+    if not armed:
+        yield None
+        return
+
+    directory = os.path.join(PROFILE_DIR, datetime.now().strftime("%Y%m%d_%H%M%S_%f"))
+    try:
+        session = ProfileSession(directory)
+        sampler = _StackSampler(threading.get_ident())
+        sampler.start()
+    except Exception as e:
+        with _state_lock:
+            _active -= 1
+        logger.error(f"Could not start profiling, serving the request unprofiled: {str(e)}")
+        yield None
+        return
+
+    _local.session = session
+    start = time.perf_counter()
+    try:
+        yield session
+    finally:
+        sampler.stop()
+        _local.session = None
+        with _state_lock:
+            _active -= 1
+        try:
+            sampler.write(os.path.join(directory, "render.folded"))
+            last_profile_dir = directory
+            logger.info(f"Profiled request in {time.perf_counter() - start:.3f}s, written to {directory}")
+        except Exception as e:
+            logger.error(f"Could not write profile to {directory}: {str(e)}")
+
+
+def section(name):
+    """cProfile the block if the current request is being profiled."""
+    if not _active:
+        return _NULL_CONTEXT
+    session = getattr(_local, "session", None)
+    if session is None:
+        return _NULL_CONTEXT
+    return session.python_profile(name)
+
+
+def tf_trace():
+    """Capture a TensorFlow trace of the block if the current request is being profiled."""
+    if not _active:
+        return _NULL_CONTEXT
+    session = getattr(_local, "session", None)
+    if session is None:
+        return _NULL_CONTEXT
+    return session.tf_trace()
@@ -0,0 +1,275 @@
+"""
+Fast classifier-head retraining on cached backbone features.
+
+Fine-tuning the full ResNet101V2 takes hours. When only the classifier head
+needs to change (a new class, rebalanced class weights), the backbone output
+for each image never changes, so it is computed once and cached:
+
+1. Pooled backbone features of every image are stored in a chunked feature
+   store (``.npy`` chunks, memory-mapped on load) keyed by the SHA-1 of the
+   image file. Rerunning on a grown directory only extracts the new images.
+2. The head (dropout + 1024 dense + softmax, as in the notebook) is trained
+   directly on the cached features.
+3. The trained head is stacked on the backbone and saved as a single Keras
+   model that ``load_model_safely`` can serve (add it to
+   ``models/registry.json``).
+
+Images are labeled by ``utils.label_from_path`` on every run; the store
+only holds feature vectors, so moving an image to another class takes effect
+on the next retrain. The head always has one output per ``CLASS_NAMES``
+entry: to add a class, add it to ``CLASS_NAMES`` (and ``PARASITE_INFO``)
+first, so the app can name the new output.
+
+Usage:
+    python retrain_head.py train-data --output models/model_head.keras
+    python retrain_head.py train-data --extract-only
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+
+import autotune
+from utils import CLASS_NAMES, balanced_class_weights, build_head, list_labeled_images, logger, stream_batches
+
+DEFAULT_STORE_DIR = "features"
+CHUNK_SIZE = 1024
+
+
+def file_hash(path):
+    """SHA-1 of the file contents, or of every file in a directory (a SavedModel) in sorted order."""
+    digest = hashlib.sha1()
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+        )
+    else:
+        files = [path]
+    for file_path in files:
+        if file_path != path:
+            digest.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class FeatureStore:
+    """Chunked, memory-mapped store of backbone features keyed by image hash."""
+
+    def __init__(self, directory, backbone):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+            if self.index["backbone"] != backbone:
+                raise ValueError(
+                    f"Feature store {directory} was built with backbone {self.index['backbone']}, "
+                    f"not {backbone}. Use a different --store directory."
+                )
+        else:
+            self.index = {"backbone": backbone, "feature_dim": None, "chunks": []}
+        self._hashes = {h for chunk in self.index["chunks"] for h in chunk["hashes"]}
+
+    def __contains__(self, image_hash):
+        return image_hash in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def append(self, features, hashes):
+        """Write a new chunk of features with their image hashes."""
+        os.makedirs(self.directory, exist_ok=True)
+        file_name = f"chunk_{len(self.index['chunks']):05d}.npy"
+        np.save(os.path.join(self.directory, file_name), np.asarray(features, dtype=np.float32))
+        self.index["feature_dim"] = int(features.shape[1])
+        self.index["chunks"].append({"file": file_name, "hashes": list(hashes)})
+        self._hashes.update(hashes)
+
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def load(self, hashes=None):
+        """
+        Read features, optionally restricted to a set of image hashes.
+
+        Returns:
+            Tuple: (features array, list of the image hash of each row)
+        """
+        features, row_hashes = [], []
+        for chunk in self.index["chunks"]:
+            data = np.load(os.path.join(self.directory, chunk["file"]), mmap_mode="r")
+            if hashes is None:
+                features.append(data)
+                row_hashes.extend(chunk["hashes"])
+                continue
+            rows = [i for i, h in enumerate(chunk["hashes"]) if h in hashes]
+            if rows:
+                features.append(data[rows])
+                row_hashes.extend(chunk["hashes"][i] for i in rows)
+        if not features:
+            return np.empty((0, self.index["feature_dim"] or 0), dtype=np.float32), []
+        return np.concatenate(features), row_hashes
+
+
+def split_model(model):
+    """
+    Split a trained classifier into its feature backbone and head.
+
+    Returns:
+        Tuple: (list of backbone layers ending with the global pooling, list of head layers)
+    """
+    for i, layer in enumerate(model.layers):
+        if isinstance(layer, layers.GlobalAveragePooling2D):
+            return model.layers[:i + 1], model.layers[i + 1:]
+    raise ValueError("Model has no GlobalAveragePooling2D layer to split at.")
+
+
+def extract_features(store, extractor, items, batch_size=32, workers=4):
+    """
+    Extract and store features for images not already in the store.
+
+    Args:
+        store: The FeatureStore to append to.
+        extractor: Model mapping preprocessed images to pooled features.
+        items: List of (path, class index) tuples.
+        batch_size: Images per forward pass.
+        workers: Number of decoding threads.
+
+    Returns:
+        Dict mapping the hash of every given image to its current class index.
+    """
+    hashes = [file_hash(path) for path, _ in items]
+    new = [i for i, h in enumerate(hashes) if h not in store]
+    # Identical files may appear more than once; extract each only once
+    new = list({hashes[i]: i for i in new}.values())
+    logger.info(f"{len(items)} images, {len(items) - len(new)} already cached, {len(new)} to extract.")
+
+    pending_features, pending_hashes = [], []
+    for images, rows in stream_batches([(items[i][0], i) for i in new], batch_size, workers):
+        pending_features.append(extractor.predict_on_batch(images))
+        pending_hashes.extend(hashes[i] for i in rows)
+        if len(pending_hashes) >= CHUNK_SIZE:
+            store.append(np.concatenate(pending_features), pending_hashes)
+            logger.info(f"Cached {len(store)} images.")
+            pending_features, pending_hashes = [], []
+    if pending_hashes:
+        store.append(np.concatenate(pending_features), pending_hashes)
+
+    labels = {}
+    for (path, label), image_hash in zip(items, hashes):
+        if labels.setdefault(image_hash, label) != label:
+            logger.warning(
+                f"{path} duplicates an image in another class; keeping {CLASS_NAMES[labels[image_hash]]}."
+            )
+    return labels
+
+
+def train_head(features, y, num_classes, epochs=50, batch_size=256, learning_rate=1e-3,
+               validation_split=0.1, seed=42):
+    """
+    Train a fresh head on cached features.
+
+    Returns:
+        Tuple: (trained head model, Keras History)
+    """
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(y))
+    num_val = int(len(y) * validation_split)
+    val_idx, train_idx = order[:num_val], order[num_val:]
+
+    train_ds = tf.data.Dataset.from_tensor_slices((features[train_idx], y[train_idx]))
+    train_ds = train_ds.shuffle(len(train_idx), seed=seed).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    val_ds = None
+    if num_val:
+        val_ds = tf.data.Dataset.from_tensor_slices((features[val_idx], y[val_idx])).batch(batch_size)
+
+    head = build_head(features.shape[1], num_classes)
+    head.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate),
+        loss="sparse_categorical_crossentropy",
+        metrics=["accuracy"],
+    )
+    monitor = "val_loss" if val_ds is not None else "loss"
+    history = head.fit(
+        train_ds,
+        validation_data=val_ds,
+        epochs=epochs,
+        class_weight=balanced_class_weights(y[train_idx], num_classes),
+        callbacks=[tf.keras.callbacks.EarlyStopping(monitor=monitor, patience=5, restore_best_weights=True)],
+        verbose=2,
+    )
+    return head, history
+
+
+def export_model(backbone_layers, head, path):
+    """Stack the head on the backbone and save a servable model."""
+    model = tf.keras.Sequential(backbone_layers + head.layers)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Keras 2.12 writes a SavedModel directory for ".keras" paths unless asked for the native format
+    model.save(path, save_format="keras_v3")
+    return model
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Retrain the classifier head on cached backbone features.")
+    parser.add_argument("data_dir", help="Directory of labeled images")
+    parser.add_argument("--backbone", default="models/model.keras", help="Model whose backbone is reused")
+    parser.add_argument("--store", default=DEFAULT_STORE_DIR, help="Feature store directory")
+    parser.add_argument("--output", default="models/model_head.keras", help="Where to save the combined model")
+    parser.add_argument("--extract-only", action="store_true", help="Only update the feature store")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=256, help="Head training batch size")
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--extract-batch-size", type=int, help="Defaults to the tuned batch size, else 32")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Decoding threads")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    items = list_labeled_images(args.data_dir)
+    if not items:
+        logger.error(f"No labeled images found in {args.data_dir}")
+        return 1
+
+    runtime_config = autotune.configure_runtime(args.backbone, workload="offline")
+    extract_batch_size = args.extract_batch_size or runtime_config.get("batch_size", autotune.DEFAULT_BATCH_SIZE)
+    backbone_layers, _ = split_model(tf.keras.models.load_model(args.backbone))
+    extractor = tf.keras.Sequential(backbone_layers)
+
+    # Key the store on the backbone weights so a new model never reuses stale features
+    store = FeatureStore(args.store, f"{os.path.basename(args.backbone)}:{file_hash(args.backbone)}")
+    labels = extract_features(store, extractor, items, extract_batch_size, args.workers)
+    if args.extract_only:
+        return 0
+
+    # Labels come from the directory as it is now; the store only provides features
+    features, row_hashes = store.load(set(labels))
+    y = np.array([labels[image_hash] for image_hash in row_hashes], dtype=np.int64)
+    num_classes = len(CLASS_NAMES)
+    missing = [CLASS_NAMES[i] for i in range(num_classes) if not np.any(y == i)]
+    if missing:
+        logger.warning(f"No training images for {missing}; the head cannot learn these classes.")
+    logger.info(f"Training head on {len(y)} cached feature vectors, {num_classes} classes.")
+
+    head, history = train_head(features, y, num_classes, args.epochs, args.batch_size, args.learning_rate)
+    if "val_accuracy" in history.history:
+        logger.info(f"Best validation accuracy: {max(history.history['val_accuracy']):.4f}")
+
+    export_model(backbone_layers, head, args.output)
+    logger.info(f"Combined model saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
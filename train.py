@@ -0,0 +1,390 @@
+"""
+Full-model training with a tf.data input pipeline.
+
+Replaces the notebook's ``ImageDataGenerator.flow_from_directory``, which
+augments in single-threaded Python, with a pipeline that decodes in parallel,
+caches the resized images, augments on-graph and prefetches:
+
+    files -> parallel decode + resize (utils.load_resized_image) -> cache (uint8)
+          -> shuffle -> batch -> rescale + rotation/flip augmentation -> prefetch
+
+Decoding and resizing run the app's own PIL code through ``tf.numpy_function``
+rather than TF's JPEG decoder and resize kernels, which differ from PIL by a
+few intensity levels. Training therefore sees exactly the pixels that
+``utils.preprocess_image`` produces when serving; ``--check-preprocessing``
+verifies this on ``data_samples``. The decode cost is paid once, in the
+first epoch, since later epochs read the cache. The model, augmentation,
+class weighting and learning-rate schedule follow the notebook (see
+PROJECT-WORKFLOW.md).
+
+Usage:
+    python train.py train-data --val-dir validation-data --output models/model_trained.keras
+    python train.py train-data --mixed-precision --cache-file /tmp/train.cache
+    python train.py train-data --benchmark-only
+    python train.py --check-preprocessing
+"""
+import os
+import sys
+import glob
+import time
+import random
+import hashlib
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import layers
+from tensorflow.keras.applications import ResNet101V2
+
+from utils import (CLASS_NAMES, IMAGE_SIZE, balanced_class_weights, build_head, list_labeled_images,
+                   load_preprocessed_image, load_resized_image, logger, scale_tensor)
+
+AUTOTUNE = tf.data.AUTOTUNE
+ROTATION_DEGREES = 20
+# Training is reported as input-bound when the input pipeline is not at least this much faster
+INPUT_BOUND_MARGIN = 1.2
+# Largest allowed absolute difference between pipeline and serving preprocessing. Both run the
+# same PIL code and the same float32 division, so any difference at all means they have diverged.
+PREPROCESSING_TOLERANCE = 1e-6
+
+
+def decode_image(path, target_size=IMAGE_SIZE):
+    """Read, decode and resize one image file to uint8 with the app's PIL preprocessing."""
+    image = tf.numpy_function(lambda p: load_resized_image(p, target_size), [path], tf.uint8, stateful=False)
+    image.set_shape(tuple(target_size) + (3,))
+    return image
+
+
+def build_augmentation():
+    """On-graph equivalent of the notebook's ImageDataGenerator augmentation."""
+    return tf.keras.Sequential([
+        layers.RandomRotation(ROTATION_DEGREES / 360, fill_mode="nearest"),
+        layers.RandomFlip("horizontal_and_vertical"),
+    ], name="augmentation")
+
+
+def cache_path(cache_file, items, target_size=IMAGE_SIZE):
+    """
+    Key a file cache on the images it holds.
+
+    ``tf.data`` reads an existing cache file without looking at the files it
+    was built from, so the path gets a digest of every (path, label,
+    modification time) and the image size: adding, relabeling or editing an
+    image starts a new cache instead of training on the old one. Lock files
+    left by a run that crashed while writing are removed, so the cache is
+    rebuilt rather than failing with ``AlreadyExistsError``.
+
+    Args:
+        cache_file: Base path of the cache; "" (in memory) and None (no cache) are returned as is.
+        items: List of (path, class index) tuples in the dataset.
+        target_size: Spatial size of the cached images.
+    """
+    if not cache_file:
+        return cache_file
+    digest = hashlib.sha1(repr(tuple(target_size)).encode())
+    for path, label in sorted(items):
+        digest.update(f"{path}\0{label}\0{os.path.getmtime(path)}\n".encode())
+    path = f"{cache_file}.{digest.hexdigest()[:16]}"
+    for lockfile in glob.glob(f"{glob.escape(path)}*.lockfile"):
+        logger.warning(f"Removing {lockfile} left by an interrupted run; the cache will be rebuilt.")
+        os.remove(lockfile)
+    return path
+
+
+def build_dataset(paths, labels, num_classes, batch_size=32, training=False,
+                  cache_file="", shuffle_buffer=2048, target_size=IMAGE_SIZE):
+    """
+    Build a batched, prefetched dataset of (images, one-hot labels).
+
+    Args:
+        paths: Image file paths.
+        labels: Integer class indices aligned with ``paths``.
+        num_classes: Number of classes for one-hot encoding.
+        batch_size: Images per batch.
+        training: Shuffle and augment when True.
+        cache_file: File to cache decoded images in; "" caches in memory, None disables caching.
+        shuffle_buffer: Number of decoded images in the shuffle buffer.
+        target_size: Spatial size of the images.
+    """
+    ds = tf.data.Dataset.from_tensor_slices((list(paths), list(labels)))
+    ds = ds.map(
+        lambda path, label: (decode_image(path, target_size), tf.one_hot(label, num_classes)),
+        num_parallel_calls=AUTOTUNE,
+        deterministic=not training,
+    )
+    if cache_file is not None:
+        ds = ds.cache(cache_file)
+    if training:
+        ds = ds.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size, drop_remainder=training)
+
+    if training:
+        augmentation = build_augmentation()
+        ds = ds.map(
+            lambda images, labels: (augmentation(scale_tensor(images), training=True), labels),
+            num_parallel_calls=AUTOTUNE,
+            deterministic=False,
+        )
+    else:
+        ds = ds.map(lambda images, labels: (scale_tensor(images), labels), num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+
+def benchmark_dataset(ds, steps=50):
+    """
+    Measure input pipeline throughput on its own, without the model.
+
+    Returns:
+        Images per second over ``steps`` batches, after one warm-up batch.
+    """
+    iterator = iter(ds)
+    next(iterator)
+    images = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        try:
+            batch, _ = next(iterator)
+        except StopIteration:
+            break
+        images += int(batch.shape[0])
+    elapsed = time.perf_counter() - start
+    return images / elapsed if elapsed > 0 else 0.0
+
+
+def check_preprocessing(paths, tolerance=PREPROCESSING_TOLERANCE, target_size=IMAGE_SIZE):
+    """
+    Compare the pipeline's preprocessing with ``preprocess_image`` image by image.
+
+    Args:
+        paths: Image files to compare on.
+        tolerance: Largest allowed absolute pixel difference, on the 0-1 scale.
+        target_size: Spatial size of the images.
+
+    Returns:
+        The largest absolute difference found.
+    """
+    ds = tf.data.Dataset.from_tensor_slices(list(paths))
+    ds = ds.map(lambda path: scale_tensor(decode_image(path, target_size)))
+    max_difference = 0.0
+    for path, image in zip(paths, ds.as_numpy_iterator()):
+        difference = float(np.max(np.abs(image - load_preprocessed_image(path, target_size))))
+        if difference > tolerance:
+            raise ValueError(
+                f"Training preprocessing differs from serving on {path} by {difference:.2e} "
+                f"(tolerance {tolerance:.0e})."
+            )
+        max_difference = max(max_difference, difference)
+    return max_difference
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """
+    Logs training throughput per epoch and whether training is input-bound.
+
+    Args:
+        batch_size: Images per training batch.
+        input_images_per_second: Throughput of the uncached pipeline, which the first epoch runs.
+        dataset: The training dataset; if it is cached, it is benchmarked again once the
+            first epoch has filled the cache, and later epochs are compared against that.
+        benchmark_steps: Batches used for that second benchmark.
+    """
+
+    def __init__(self, batch_size, input_images_per_second=None, dataset=None, benchmark_steps=50):
+        super().__init__()
+        self.batch_size = batch_size
+        self.input_images_per_second = input_images_per_second
+        self.dataset = dataset
+        self.benchmark_steps = benchmark_steps
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+        self._last = self._start
+        self._steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+        self._last = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = self._last - self._start
+        if not self._steps or elapsed <= 0:
+            return
+        images_per_second = self._steps * self.batch_size / elapsed
+        if logs is not None:
+            logs["images_per_second"] = images_per_second
+        message = f"Epoch {epoch + 1}: {images_per_second:.1f} images/s"
+        if self.input_images_per_second:
+            headroom = self.input_images_per_second / images_per_second
+            message += f", input pipeline {self.input_images_per_second:.1f} images/s ({headroom:.2f}x)"
+            if headroom < INPUT_BOUND_MARGIN:
+                message += " - training is likely input-bound"
+        logger.info(message)
+
+        if epoch == 0 and self.dataset is not None and self.input_images_per_second:
+            # Later epochs read the now complete cache instead of decoding
+            self.input_images_per_second = benchmark_dataset(self.dataset, self.benchmark_steps)
+            self.dataset = None
+            logger.info(f"Input pipeline (cached): {self.input_images_per_second:.1f} images/s")
+
+
+def build_model(num_classes, weights="imagenet", mixed_precision=False):
+    """The notebook's ResNet101V2 classifier, with a float32 output layer under mixed precision."""
+    base_model = ResNet101V2(input_shape=IMAGE_SIZE + (3,), include_top=False, weights=weights)
+    base_model.trainable = True
+    head = build_head(base_model.output_shape[-1], num_classes,
+                      output_dtype="float32" if mixed_precision else None)
+    return tf.keras.Sequential([base_model, layers.GlobalAveragePooling2D()] + head.layers)
+
+
+def lr_schedule(epoch):
+    """The notebook's schedule: 4.5e-5, divided by 1.5 * (epoch // 8) from epoch 8."""
+    initial_lr = 4.5e-5
+    decrease_factor = 1.5
+    if epoch >= 8:
+        return initial_lr / (decrease_factor * (epoch // 8))
+    return initial_lr
+
+
+def split_items(items, validation_split, seed=42):
+    """Per-class random split of (path, class index) items, like the notebook's 10% validation split."""
+    rng = random.Random(seed)
+    by_class = {}
+    for item in items:
+        by_class.setdefault(item[1], []).append(item)
+    train, val = [], []
+    for class_items in by_class.values():
+        rng.shuffle(class_items)
+        num_val = int(len(class_items) * validation_split)
+        val.extend(class_items[:num_val])
+        train.extend(class_items[num_val:])
+    return train, val
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Train the classifier with a tf.data input pipeline.")
+    parser.add_argument("train_dir", nargs="?", help="Training images, one subdirectory per class")
+    parser.add_argument("--val-dir", help="Validation images; otherwise split from train_dir")
+    parser.add_argument("--validation-split", type=float, default=0.1)
+    parser.add_argument("--output", default="models/model_trained.keras", help="Where to save the best model")
+    parser.add_argument("--epochs", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--weights", default="imagenet", help="Initial backbone weights")
+    parser.add_argument("--mixed-precision", action="store_true", help="Train with the mixed_float16 policy")
+    parser.add_argument("--cache-file", default="",
+                        help="Cache decoded images on disk instead of memory. The file name gets a digest of "
+                             "the image paths, labels and modification times, so changed data is decoded "
+                             "again into a new cache. One run per cache at a time: stale lock files are removed")
+    parser.add_argument("--no-cache", action="store_true", help="Decode images every epoch")
+    parser.add_argument("--shuffle-buffer", type=int, default=2048)
+    parser.add_argument("--benchmark-steps", type=int, default=50,
+                        help="Batches used to measure input pipeline throughput (0 to skip)")
+    parser.add_argument("--benchmark-only", action="store_true", help="Measure the input pipeline and exit")
+    parser.add_argument("--check-preprocessing", action="store_true",
+                        help="Compare the pipeline with the app's preprocessing on data_samples and exit")
+    args = parser.parse_args(argv)
+    if not args.train_dir and not args.check_preprocessing:
+        parser.error("train_dir is required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    sample_paths = [path for path, _ in list_labeled_images("data_samples")]
+    if sample_paths:
+        try:
+            max_difference = check_preprocessing(sample_paths)
+        except ValueError as e:
+            logger.error(str(e))
+            return 1
+        logger.info(f"Preprocessing matches the app on {len(sample_paths)} samples "
+                    f"(max difference {max_difference:.1e}, tolerance {PREPROCESSING_TOLERANCE:.0e}).")
+    elif args.check_preprocessing:
+        logger.error("No labeled images in data_samples to check preprocessing on.")
+        return 1
+    if args.check_preprocessing:
+        return 0
+
+    items = list_labeled_images(args.train_dir)
+    if not items:
+        logger.error(f"No labeled images found in {args.train_dir}")
+        return 1
+    if args.val_dir:
+        train_items, val_items = items, list_labeled_images(args.val_dir)
+    else:
+        train_items, val_items = split_items(items, args.validation_split)
+
+    num_classes = len(CLASS_NAMES)
+    train_paths = [path for path, _ in train_items]
+    train_labels = [label for _, label in train_items]
+    logger.info(f"{len(train_items)} training and {len(val_items)} validation images, {num_classes} classes.")
+
+    cache_file = None if args.no_cache else args.cache_file
+    train_ds = build_dataset(train_paths, train_labels, num_classes, args.batch_size, training=True,
+                             cache_file=cache_path(cache_file, train_items), shuffle_buffer=args.shuffle_buffer)
+    val_ds = None
+    if val_items:
+        val_ds = build_dataset(
+            [path for path, _ in val_items], [label for _, label in val_items],
+            num_classes, args.batch_size,
+            cache_file=cache_path(cache_file and f"{cache_file}.val", val_items),
+        )
+
+    input_images_per_second = None
+    if args.benchmark_steps or args.benchmark_only:
+        # Benchmark a separate, uncached pipeline so the training cache is not left half-filled
+        benchmark_ds = build_dataset(train_paths, train_labels, num_classes, args.batch_size,
+                                     training=True, cache_file=None, shuffle_buffer=args.shuffle_buffer)
+        input_images_per_second = benchmark_dataset(benchmark_ds, args.benchmark_steps or 50)
+        logger.info(f"Input pipeline (uncached): {input_images_per_second:.1f} images/s")
+        if args.benchmark_only:
+            return 0
+
+    if args.mixed_precision:
+        tf.keras.mixed_precision.set_global_policy("mixed_float16")
+    model = build_model(num_classes, args.weights, args.mixed_precision)
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(),
+        loss="categorical_crossentropy",
+        metrics=["accuracy"],
+    )
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    checkpoint_path = f"{args.output}.best.h5"
+    monitor = "val_loss" if val_ds is not None else "loss"
+    model.fit(
+        train_ds,
+        epochs=args.epochs,
+        validation_data=val_ds,
+        class_weight=balanced_class_weights(np.array(train_labels), num_classes),
+        callbacks=[
+            tf.keras.callbacks.LearningRateScheduler(lr_schedule),
+            tf.keras.callbacks.ModelCheckpoint(checkpoint_path, monitor=monitor, save_best_only=True,
+                                               save_weights_only=True, verbose=1),
+            tf.keras.callbacks.EarlyStopping(monitor=monitor, patience=12, restore_best_weights=True),
+            ThroughputCallback(args.batch_size, input_images_per_second,
+                               dataset=None if cache_file is None else train_ds,
+                               benchmark_steps=args.benchmark_steps),
+        ],
+    )
+
+    # EarlyStopping only restores the best weights when it stops early, so take them from the
+    # checkpoint rather than exporting the final epoch
+    if os.path.exists(checkpoint_path):
+        model.load_weights(checkpoint_path)
+    if args.mixed_precision:
+        # Serve in float32: mixed_float16 is slow or unsupported on CPU hosts
+        tf.keras.mixed_precision.set_global_policy("float32")
+        serving_model = build_model(num_classes, weights=None)
+        serving_model.set_weights(model.get_weights())
+        model = serving_model
+    # Keras 2.12 writes a SavedModel directory for ".keras" paths unless asked for the native format
+    model.save(args.output, save_format="keras_v3")
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    logger.info(f"Best model saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,15 @@
 import os
 import logging
 import tensorflow as tf
-from tensorflow.keras.models import load_model
 import streamlit as st
 from PIL import Image
 import numpy as np
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import profiling
+import autotune
+from model_registry import ModelRegistry
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -283,13 +287,36 @@ PARASITE_INFO = {
 SAMPLE_IMAGES_DIR = "data_samples"
 NUM_DISPLAYED = 7
 
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+CLASS_INDICES = {name: idx for idx, name in CLASS_NAMES.items()}
+
+# Preprocessing shared by serving (preprocess_image) and training (load_resized_image + scale_tensor)
+IMAGE_SIZE = (224, 224)
+PIXEL_MAX = 255.0
+
 @st.cache_resource
-def load_model_safely():
-    """Load the TensorFlow model safely with exception handling."""
+def load_model_registry():
+    """Create the model registry shared by all sessions."""
+    registry = ModelRegistry.from_config()
+    autotune.configure_runtime(registry.versions[registry.default])
+    return registry
+
+def load_model_safely(version=None):
+    """
+    Load a model version through the registry safely with exception handling.
+
+    Args:
+        version: Version to load; the registry's default version if omitted.
+
+    Returns:
+        A model-like object for ``predict_image``: the registry itself, which
+        routes between versions, or a view pinned to ``version`` if given.
+        None if loading failed.
+    """
     try:
-        model = load_model('models/model.keras')
-        logger.info("Model loaded successfully.")
-        return model
+        registry = load_model_registry()
+        registry.get(version)
+        return registry.pinned(version) if version else registry
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
         st.error("Failed to load the model. Please check if the model file exists.")
@@ -311,7 +338,7 @@ def load_sample_images(n=NUM_DISPLAYED):
         st.error("Failed to load sample images. Please check the directory and image files.")
     return sample_images
 
-def preprocess_image(_image, target_size=(224, 224)):
+def preprocess_image(_image, target_size=IMAGE_SIZE):
     """
     Preprocesses an image for prediction.
     
@@ -323,16 +350,161 @@ def preprocess_image(_image, target_size=(224, 224)):
         Tuple: (processed image array, error message)
     """
     try:
-        if _image.mode != "RGB":
-            _image = _image.convert("RGB")
-        image = _image.resize(target_size, Image.LANCZOS)
-        img_array = np.array(image, dtype=np.float32) / 255.0
-        img_array = np.expand_dims(img_array, axis=0)  # Add batch dimension
+        with profiling.section("preprocess_image"):
+            img_array = resize_image(_image, target_size).astype(np.float32) / PIXEL_MAX
+            img_array = np.expand_dims(img_array, axis=0)  # Add batch dimension
         return img_array, None
     except Exception as e:
         logger.error(f"Error preprocessing image: {str(e)}")
         return None, str(e)
 
+def resize_image(_image, target_size=IMAGE_SIZE):
+    """
+    Converts a PIL image to RGB and resizes it, the first step of ``preprocess_image``.
+
+    Args:
+        _image: A PIL image object to be processed.
+        target_size: Desired size for the image.
+
+    Returns:
+        uint8 array of shape target_size + (3,).
+    """
+    if _image.mode != "RGB":
+        _image = _image.convert("RGB")
+    return np.asarray(_image.resize(target_size, Image.LANCZOS), dtype=np.uint8)
+
+def scale_tensor(image):
+    """The rescaling step of ``preprocess_image`` for uint8 tensors in tf.data pipelines."""
+    return tf.cast(image, tf.float32) / PIXEL_MAX
+
+def load_resized_image(path, target_size=IMAGE_SIZE):
+    """
+    Decodes an image file with PIL and resizes it exactly as ``preprocess_image`` does.
+
+    Args:
+        path: Path to the image file (str or bytes, as passed by ``tf.numpy_function``).
+        target_size: Desired size for the image.
+
+    Returns:
+        uint8 array of shape target_size + (3,); ``scale_tensor`` completes the preprocessing.
+    """
+    if isinstance(path, bytes):
+        path = path.decode()
+    with Image.open(path) as image:
+        return resize_image(image, tuple(int(x) for x in target_size))
+
+def load_preprocessed_image(path, target_size=IMAGE_SIZE):
+    """Decodes and preprocesses an image file exactly as the app does, without the batch dimension."""
+    with Image.open(path) as image:
+        img_array, error = preprocess_image(image, target_size)
+    if error:
+        raise ValueError(f"{path}: {error}")
+    return img_array[0]
+
+def stream_batches(items, batch_size=32, workers=4, prefetch=2, target_size=IMAGE_SIZE):
+    """
+    Yield preprocessed batches while worker threads prepare the next ones.
+
+    Args:
+        items: List of (path, label) tuples.
+        batch_size: Number of images per batch.
+        workers: Number of decoding threads.
+        prefetch: Number of batches to keep in flight ahead of the consumer.
+        target_size: Spatial size passed to ``preprocess_image``.
+
+    Yields:
+        Tuple: (image batch of shape (n, h, w, 3), label array of shape (n,))
+    """
+    max_pending = max(1, prefetch) * batch_size
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        source = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    path, label = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((executor.submit(load_preprocessed_image, path, target_size), label))
+            if not pending:
+                return
+            count = min(batch_size, len(pending))
+            batch = [pending.popleft() for _ in range(count)]
+            images = np.stack([future.result() for future, _ in batch])
+            labels = np.fromiter((label for _, label in batch), dtype=np.int64, count=count)
+            yield images, labels
+
+def build_head(feature_dim, num_classes, dropout=0.3, output_dtype=None):
+    """
+    The notebook's classifier head, taking pooled backbone features as input.
+
+    Args:
+        feature_dim: Size of the pooled backbone features.
+        num_classes: Number of output classes.
+        dropout: Dropout rate before and after the dense layer.
+        output_dtype: Dtype of the softmax layer; set to float32 under mixed precision.
+    """
+    return tf.keras.Sequential([
+        tf.keras.layers.Input(shape=(feature_dim,)),
+        tf.keras.layers.Dropout(dropout),
+        tf.keras.layers.Dense(1024, activation="relu"),
+        tf.keras.layers.Dropout(dropout),
+        tf.keras.layers.Dense(num_classes, activation="softmax", dtype=output_dtype),
+    ])
+
+def balanced_class_weights(y, num_classes):
+    """Same weighting as sklearn's ``compute_class_weight('balanced')`` used in the notebook."""
+    counts = np.bincount(y, minlength=num_classes)
+    present = counts > 0
+    weights = np.zeros(num_classes)
+    weights[present] = len(y) / (present.sum() * counts[present])
+    return dict(enumerate(weights))
+
+def label_from_path(path):
+    """
+    Infer the class index of an image from its location.
+
+    Images are labeled by their parent directory (``train-data/Babesia/x.jpg``)
+    or, failing that, by the filename prefix used in ``data_samples``
+    (``Babesia_3.jpg``).
+
+    Args:
+        path: Path to the image file.
+
+    Returns:
+        The class index in CLASS_NAMES, or None if the label cannot be inferred.
+    """
+    parent = os.path.basename(os.path.dirname(path))
+    if parent in CLASS_INDICES:
+        return CLASS_INDICES[parent]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return CLASS_INDICES.get(stem.rsplit("_", 1)[0])
+
+def list_labeled_images(directory):
+    """
+    Recursively collect labeled images from a directory, skipping unlabeled ones.
+
+    Args:
+        directory: Root directory to scan.
+
+    Returns:
+        List of (path, class index) tuples, sorted by path.
+    """
+    items = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            label = label_from_path(path)
+            if label is None:
+                logger.warning(f"Skipping unlabeled image: {path}")
+                continue
+            items.append((path, label))
+    return sorted(items)
+
 def predict_image(model, img_array):
     """
     Predicts the class of an image using a trained model.
@@ -345,7 +517,8 @@ def predict_image(model, img_array):
         Tuple: (predicted class, confidence scores, error message)
     """
     try:
-        prediction = model.predict(img_array, verbose=0)
+        with profiling.tf_trace():
+            prediction = model.predict(img_array, verbose=0)
         predicted_class = np.argmax(prediction, axis=1)[0]
         confidence_scores = prediction[0]
         return predicted_class, confidence_scores, None